@@ -1,12 +1,22 @@
 from __future__ import annotations
 
+import json
+from functools import lru_cache
 from typing import TypeVar
 
 from .types import Provider
-from openai import AsyncOpenAI
-from pydantic import BaseModel
+from openai import APIError, AsyncOpenAI
+from pydantic import BaseModel, ValidationError
 import instructor
 
+try:
+    from instructor.core import InstructorError
+except ImportError:  # older instructor versions
+    from instructor.exceptions import InstructorError
+
+# Errors of a single AI request, which should not abort a whole cleanup run
+REQUEST_ERRORS = (APIError, InstructorError, ValidationError)
+
 
 def get_ai_client(provider: Provider) -> instructor.AsyncInstructor:
     """
@@ -46,3 +56,44 @@ async def get_structured_output(
         # not-quite duplicates
         temperature=0.0,
     )
+
+
+async def get_json_output(
+    client: instructor.AsyncInstructor,
+    user_prompt: str,
+    system_prompt: str,
+    type: type[BaseModel],
+    model: str | None = None,
+) -> bytes:
+    """
+    Use OpenAI API to get the raw JSON output for a response model.
+
+    Unlike `get_structured_output` the response is not parsed, which allows
+    validating it in a worker process (see `workers.validate_response`).
+    """
+    if client.client is None:
+        raise ValueError("Instructor client is not backed by an OpenAI client.")
+
+    completion = await client.client.chat.completions.create(
+        model=model,
+        messages=[
+            {
+                "role": "system",
+                "content": system_prompt
+                + "\n\nReply with a JSON object matching this JSON schema:\n"
+                + json_schema(type),
+            },
+            {"role": "user", "content": user_prompt},
+        ],
+        response_format={"type": "json_object"},
+        temperature=0.0,
+    )
+    # Let the instructor hooks see the response, e.g. to track the token usage
+    client.hooks.emit_completion_response(completion)
+    return (completion.choices[0].message.content or "").encode()
+
+
+@lru_cache
+def json_schema(type: type[BaseModel]) -> str:
+    """Return the JSON schema of a response model, as sent with every request."""
+    return json.dumps(type.model_json_schema())
@@ -1,19 +1,56 @@
 from __future__ import annotations
 import asyncio
-from collections.abc import Iterable
-from typing import Coroutine, Literal, Sequence
-
+import multiprocessing
+import os
+from collections.abc import Iterable, Mapping
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from typing import Any, Callable, Coroutine, Literal, Sequence, TypeVar, overload
+
+from beets import config as beets_config
 from beets.autotag import TrackInfo, AlbumInfo
 from beets.importer import ImportTask
 from beets.metadata_plugins import MetadataSourcePlugin
-from beets.library import Item
-from beets.ui import UserError
+from beets.library import Item, Library
+from beets.ui import Subcommand, UserError, should_move, should_write
 import confuse
+import instructor
+from pydantic import BaseModel
+
+
+from .ai import (
+    REQUEST_ERRORS,
+    get_ai_client,
+    get_json_output,
+    get_structured_output,
+    json_schema,
+)
+from .budget import (
+    OUTPUT_TOKENS_PER_ITEM,
+    BudgetGovernor,
+    estimate_tokens,
+    has_ceilings,
+)
+from .jobs import JobQueue
+from .paths import PathIndex
+from .types import (
+    Provider,
+    AISauceSource,
+    AlbumInfoAIResponse,
+    ItemChanges,
+    Job,
+    PathHints,
+    TrackInfoAIResponse,
+    apply_changes,
+    item_snapshot,
+)
+from .prompts import _default_user_prompt, _default_system_prompt
+from .workers import diff_response, item_rows, validate_response
 
 
-from .ai import get_ai_client, get_structured_output
-from .types import Provider, AISauceSource, AlbumInfoAIResponse, TrackInfoAIResponse
-from .prompts import _default_user_prompt, _default_system_prompt
+R = TypeVar("R", bound=BaseModel)
+T = TypeVar("T")
 
 
 class AISauce(MetadataSourcePlugin):
@@ -30,10 +67,20 @@ class AISauce(MetadataSourcePlugin):
                 "mode": "metadata_source",
                 "providers": [],
                 "sources": [],
+                "concurrency": 4,
+                "queue_path": "",
+                "processes": 0,
+                "path_hints": True,
             }
         )
 
+        self._pool: ProcessPoolExecutor | None = None
+        self._budget: BudgetGovernor | None = None
+        self.path_index = PathIndex()
+
+        self.register_listener("import_begin", self.on_import_begin)
         self.register_listener("import_task_start", self.on_import_task_choice)
+        self.register_listener("cli_exit", self.on_cli_exit)
 
     @property
     def mode(self) -> Literal["metadata_source", "metadata_cleanup"]:
@@ -56,6 +103,15 @@ class AISauce(MetadataSourcePlugin):
                     "api_key": str,
                     "api_base_url": str,
                     "model": str,
+                    "budget": confuse.MappingTemplate(
+                        {
+                            "cost_per_1k_tokens": confuse.Number(0.0),
+                            "max_tokens_per_run": confuse.Optional(int),
+                            "max_tokens_per_day": confuse.Optional(int),
+                            "max_cost_per_run": confuse.Optional(float),
+                            "max_cost_per_day": confuse.Optional(float),
+                        }
+                    ),
                 }
             )
         )
@@ -124,8 +180,339 @@ class AISauce(MetadataSourcePlugin):
 
         return rets
 
+    @property
+    def concurrency(self) -> int:
+        """Return the number of cleanup jobs processed at the same time."""
+        concurrency = self.config["concurrency"].get(int)
+        if concurrency < 1:
+            raise UserError(
+                f"AISauce plugin concurrency must be at least 1, got: {concurrency}"
+            )
+        return concurrency
+
+    @property
+    def queue_path(self) -> str:
+        """Return the path of the cleanup job database, by default in the beets directory."""
+        path = self.config["queue_path"].get(str)
+        if path:
+            return os.path.expanduser(path)
+        return os.path.join(beets_config.config_dir(), "aisauce_jobs.db")
+
+    @property
+    def processes(self) -> int:
+        """Return the number of worker processes for prompt rendering and
+        response validation, 0 disables the process pool."""
+        processes = self.config["processes"].get(int)
+        if processes < 0:
+            raise UserError(
+                f"AISauce plugin processes must not be negative, got: {processes}"
+            )
+        return processes
+
+    @property
+    def path_hints(self) -> bool:
+        """Whether to send folder-level hints instead of the raw file paths."""
+        return self.config["path_hints"].get(bool)
+
+    # -------------------------------- Process pool ------------------------------ #
+
+    @property
+    def pool(self) -> Executor | None:
+        """Return the process pool for CPU-bound work, created on first use.
+
+        None if disabled, in which case everything runs on the event loop.
+        """
+        if self.processes == 0:
+            return None
+        if self._pool is None:
+            # Never fork, the pool is created from the importer's threads
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self._pool
+
+    def shutdown_pool(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    # ---------------------------------- Budget ---------------------------------- #
+
+    @property
+    def budget(self) -> BudgetGovernor | None:
+        """Return the budget governor, tracking the usage of all providers.
+
+        None if no provider has a ceiling, in which case usage is not tracked.
+        """
+        if not any(has_ceilings(p) for p in self.providers):
+            return None
+        if self._budget is None:
+            self._budget = BudgetGovernor(
+                self.providers,
+                os.path.join(beets_config.config_dir(), "aisauce_usage.db"),
+            )
+        return self._budget
+
+    def on_cli_exit(self, lib: Library | None = None):
+        self.shutdown_pool()
+        if self._budget is not None:
+            self._budget.close()
+            self._budget = None
+
+    # ------------------------------ Library cleanup ----------------------------- #
+
+    def commands(self) -> list[Subcommand]:
+        cmd = Subcommand("aisauce", help="clean up library metadata using AI")
+        cmd.parser.add_option(
+            "-s",
+            "--singletons",
+            action="store_true",
+            help="clean up singleton items instead of albums",
+        )
+        cmd.parser.add_option(
+            "-r",
+            "--resume",
+            action="store_true",
+            help="resume the interrupted cleanup run, retrying failed jobs",
+        )
+        cmd.parser.add_option(
+            "--restart",
+            action="store_true",
+            help="discard the unfinished cleanup run and start a new one",
+        )
+        cmd.func = self.cleanup_command
+        return [cmd]
+
+    def cleanup_command(self, lib: Library, opts, args: list[str]):
+        if opts.resume and opts.restart:
+            raise UserError("--resume and --restart can not be used together.")
+
+        queue = JobQueue(self.queue_path)
+        try:
+            if opts.resume:
+                requeued = queue.requeue()
+                self._log.info(f"Resuming cleanup run, requeued {requeued} jobs.")
+            else:
+                if queue.unfinished and not opts.restart:
+                    raise UserError(
+                        "An unfinished AISauce cleanup run exists, "
+                        "use --resume to continue or --restart to discard it."
+                    )
+                queue.clear()
+                if opts.singletons:
+                    for item in lib.items(args + ["singleton:true"]):
+                        queue.add_items([item.id])  # type: ignore[list-item]
+                else:
+                    for album in lib.albums(args):
+                        queue.add_album(album.id)  # type: ignore[arg-type]
+
+            # Precompute the folder hints over everything we are about to clean up
+            self.path_index = PathIndex()
+            self.path_index.roots.add(os.fsdecode(lib.directory))
+            if self.path_hints:
+                for job in queue.jobs("pending"):
+                    self.path_index.add_items(_job_items(lib, job))
+
+            asyncio.run(self._run_queue(lib, queue))
+
+            counts = queue.counts()
+            self._log.info(
+                f"AISauce: Cleanup finished, {counts['done']} jobs done, "
+                f"{counts['failed']} failed."
+            )
+        finally:
+            queue.close()
+
+    async def _run_queue(self, lib: Library, queue: JobQueue):
+        """Drain the job queue with `concurrency` workers sharing one client."""
+        source = self.sources[0]
+        write, move = should_write(), should_move()
+
+        async def worker():
+            while (job := queue.claim()) is not None:
+                items = _job_items(lib, job)
+                if not items:
+                    queue.mark_failed(job["id"], "no items found in library")
+                    continue
+
+                try:
+                    result = await self._cleanup_request(
+                        source, items, self._path_hints(items)
+                    )
+                except REQUEST_ERRORS as e:
+                    self._log.warning(f"AISauce: Cleanup job {job['id']} failed: {e}")
+                    queue.mark_failed(job["id"], str(e))
+                    continue
+                if result is None:
+                    # Retried with the next --resume, once there is budget again
+                    queue.mark_failed(job["id"], "budget exhausted")
+                    continue
+
+                self._apply_cleanup(items, result[1])
+                with lib.transaction():
+                    # Unchanged files are neither rewritten nor moved
+                    for item, changes in zip(items, result[1]):
+                        if changes:
+                            item.try_sync(write, move)
+                    if job["album_id"] is not None:
+                        _sync_album(lib, job["album_id"], items)
+                queue.mark_done(job["id"])
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+    # -------------------------------- AI requests ------------------------------- #
+
+    async def _prepare(
+        self,
+        source: AISauceSource,
+        items: Sequence[Item],
+        type: type[BaseModel],
+        **hints: Any,
+    ) -> tuple[Provider, str, int] | None:
+        """
+        Render the user prompt and pick the provider to send it to.
+
+        Returns the provider, the prompt and its estimated size in tokens (0 if
+        no budgets are configured), or None if no provider has enough budget
+        left.
+        """
+        if self.pool is None:
+            user_prompt = _format_user_prompt(source["user_prompt"], items, **hints)
+        else:
+            user_prompt = await asyncio.get_running_loop().run_in_executor(
+                self.pool,
+                partial(
+                    _format_user_prompt,
+                    source["user_prompt"],
+                    item_rows(items),
+                    **hints,
+                ),
+            )
+
+        budget = self.budget
+        if budget is None:
+            return source["provider"], user_prompt, 0
+
+        # The response schema is sent along, as a tool or in the system prompt
+        estimate = estimate_tokens(
+            source["system_prompt"] + user_prompt + json_schema(type)
+        ) + OUTPUT_TOKENS_PER_ITEM * len(items)
+        provider = budget.select(source["provider"], estimate)
+        if provider is None:
+            self._log.warning(
+                f"AISauce: Budget of provider {source['provider']['id']} exhausted, "
+                "skipping request."
+            )
+            return None
+        if provider["id"] != source["provider"]["id"]:
+            self._log.info(
+                f"AISauce: Budget of provider {source['provider']['id']} exhausted, "
+                f"falling back to {provider['id']}."
+            )
+        return provider, user_prompt, estimate
+
+    def _client(
+        self, provider: Provider, budget: BudgetGovernor | None
+    ) -> instructor.AsyncInstructor:
+        client = get_ai_client(provider)
+        if budget is not None:
+            client.on("completion:response", partial(budget.record_response, provider))
+        return client
+
+    @overload
+    async def _request(
+        self,
+        source: AISauceSource,
+        items: Sequence[Item],
+        type: type[R],
+        process: None = None,
+        **hints: Any,
+    ) -> R | None: ...
+
+    @overload
+    async def _request(
+        self,
+        source: AISauceSource,
+        items: Sequence[Item],
+        type: type[R],
+        process: Callable[[R], T],
+        **hints: Any,
+    ) -> T | None: ...
+
+    async def _request(self, source, items, type, process=None, **hints):
+        """
+        Ask the AI of the given source for a structured response about the items.
+
+        `process` is applied to the validated response, e.g. to diff it. With a
+        process pool, prompt rendering, response validation and `process` are
+        moved off the event loop, which then only waits for the API. Returns
+        None if the request was skipped because of the budget.
+        """
+        prepared = await self._prepare(source, items, type, **hints)
+        if prepared is None:
+            return None
+        provider, user_prompt, estimate = prepared
+
+        budget = self.budget
+        client = self._client(provider, budget)
+        with nullcontext() if budget is None else budget.reserve(provider, estimate):
+            if self.pool is None:
+                response = await get_structured_output(
+                    client=client,
+                    user_prompt=user_prompt,
+                    system_prompt=source["system_prompt"],
+                    type=type,
+                    model=provider["model"],
+                )
+                return response if process is None else process(response)
+            raw = await get_json_output(
+                client=client,
+                user_prompt=user_prompt,
+                system_prompt=source["system_prompt"],
+                type=type,
+                model=provider["model"],
+            )
+        return await asyncio.get_running_loop().run_in_executor(
+            self.pool, validate_response, type, raw, process
+        )
+
+    async def _cleanup_request(
+        self,
+        source: AISauceSource,
+        items: Sequence[Item],
+        path_hints: PathHints | None = None,
+    ) -> tuple[AlbumInfoAIResponse, list[ItemChanges]] | None:
+        """Ask the AI of the given source to clean up the metadata of the items.
+
+        Returns the response and its changes to the items, which are not applied
+        yet, or None if the request was skipped because of the budget.
+        """
+        snapshots = [item_snapshot(item) for item in items]
+        return await self._request(
+            source,
+            items,
+            AlbumInfoAIResponse,
+            partial(diff_response, snapshots=snapshots),
+            path_hints=path_hints,
+        )
+
     # ------------------------------- Source lookup ------------------------------ #
 
+    def on_import_begin(self, session):
+        """Index the folders of the import once, before any album is looked up."""
+        self.path_index = PathIndex()
+        if not self.path_hints:
+            return
+        for path in session.paths:
+            self.path_index.add_tree(path)
+
+    def _path_hints(self, items: Sequence[Item]) -> PathHints | None:
+        if not self.path_hints:
+            return None
+        self.path_index.add_items(items)
+        return self.path_index.hints(items)
+
     def on_import_task_choice(self, task: ImportTask, session):
         if self.mode != "metadata_cleanup":
             # AISauce is not intended to be used as a candidate source when
@@ -134,32 +521,26 @@ class AISauce(MetadataSourcePlugin):
 
         self._log.info("Enhancing metadata using AI before candidate lookup...")
 
-        async def _run():
-            source = self.sources[0]
-            provider = source["provider"]
-            client = get_ai_client(provider)
-            return await get_structured_output(
-                client=client,
-                user_prompt=_format_user_prompt(
-                    source["user_prompt"],
-                    task.items,
-                ),
-                system_prompt=source["system_prompt"],
-                type=AlbumInfoAIResponse,
-                model=provider["model"],
-            )
+        source = self.sources[0]
+        result = asyncio.run(
+            self._cleanup_request(source, task.items, self._path_hints(task.items))
+        )
+        if result is None:
+            return
+        self._apply_cleanup(task.items, result[1])
+
+        self._log.info("AISauce: Metadata enhancement complete.")
 
-        candidate = asyncio.run(_run())
-        diff = candidate.apply_to_items(task.items)
-        for item, changes in zip(task.items, diff):
+    def _apply_cleanup(self, items: list[Item], diff: list[ItemChanges]):
+        """Apply the changes of a cleanup response to the items and log them."""
+        apply_changes(items, diff)
+        for item, changes in zip(items, diff):
             if not changes:
                 continue
             self._log.info(f"Updated metadata for {item.path!r}:")
             for field, change in changes.items():
                 self._log.info(f"  {field}: {change['old']} -> {change['new']}")
 
-        self._log.info("AISauce: Metadata enhancement complete.")
-
     def album_for_id(self, album_id: str) -> AlbumInfo | None:
         # Lookup by album ID is not supported in AISauce
         return None
@@ -180,30 +561,28 @@ class AISauce(MetadataSourcePlugin):
             # operating in metadata cleanup mode.
             return []
 
-        async def _run() -> list[AlbumInfoAIResponse]:
-            tasks: list[Coroutine[None, None, AlbumInfoAIResponse]] = []
+        async def _run() -> list[AlbumInfoAIResponse | None]:
+            tasks: list[Coroutine[None, None, AlbumInfoAIResponse | None]] = []
             for source in self.sources:
-                provider = source["provider"]
-                client = get_ai_client(provider)
                 tasks.append(
-                    get_structured_output(
-                        client=client,
-                        user_prompt=_format_user_prompt(
-                            source["user_prompt"],
-                            items,
-                            artist=artist,
-                            album=album,
-                            va_likely=va_likely,
-                        ),
-                        system_prompt=source["system_prompt"],
-                        type=AlbumInfoAIResponse,
-                        model=provider["model"],
+                    self._request(
+                        source,
+                        items,
+                        AlbumInfoAIResponse,
+                        artist=artist,
+                        album=album,
+                        va_likely=va_likely,
+                        path_hints=self._path_hints(items),
                     )
                 )
             return await asyncio.gather(*tasks)
 
         candidates = asyncio.run(_run())
-        return [c.to_album_info(data_source=self.data_source) for c in candidates]
+        return [
+            c.to_album_info(data_source=self.data_source)
+            for c in candidates
+            if c is not None
+        ]
 
     def item_candidates(
         self,
@@ -219,46 +598,77 @@ class AISauce(MetadataSourcePlugin):
             # operating in metadata cleanup mode.
             return []
 
-        async def _run() -> list[TrackInfoAIResponse]:
-            tasks: list[Coroutine[None, None, TrackInfoAIResponse]] = []
+        async def _run() -> list[TrackInfoAIResponse | None]:
+            tasks: list[Coroutine[None, None, TrackInfoAIResponse | None]] = []
             for source in self.sources:
-                provider = source["provider"]
-                client = get_ai_client(provider)
                 tasks.append(
-                    get_structured_output(
-                        client=client,
-                        user_prompt=_format_user_prompt(
-                            source["user_prompt"],
-                            [item],
-                            artist=artist,
-                        ),
-                        system_prompt=source["system_prompt"],
-                        type=TrackInfoAIResponse,
-                        model=provider["model"],
+                    self._request(
+                        source,
+                        [item],
+                        TrackInfoAIResponse,
+                        artist=artist,
+                        path_hints=self._path_hints([item]),
                     )
                 )
             return await asyncio.gather(*tasks)
 
-        item_candidates: list[TrackInfoAIResponse] = asyncio.run(_run())
-        return [i.to_track_info(data_source=self.data_source) for i in item_candidates]
+        item_candidates = asyncio.run(_run())
+        return [
+            i.to_track_info(data_source=self.data_source)
+            for i in item_candidates
+            if i is not None
+        ]
+
+
+def _job_items(lib: Library, job: Job) -> list[Item]:
+    """Load the items of a cleanup job from the library."""
+    if job["album_id"] is not None:
+        album = lib.get_album(job["album_id"])
+        return list(album.items()) if album else []
+    items = (lib.get_item(item_id) for item_id in job["item_ids"])
+    return [item for item in items if item]
+
+
+# Album-level fields set by a cleanup, see `AlbumInfoAIResponse.diff`
+_ALBUM_FIELDS = ("album", "albumartist", "genre", "year", "label", "comp")
+
+
+def _sync_album(lib: Library, album_id: int, items: Sequence[Item]):
+    """Derive the album-level fields from the cleaned up items, where they agree."""
+    album = lib.get_album(album_id)
+    if album is None:
+        return
+    for field in _ALBUM_FIELDS:
+        values = {item.get(field) for item in items}
+        if len(values) == 1 and (value := values.pop()) is not None:
+            album[field] = value
+    album.store(inherit=False)
 
 
 def _format_user_prompt(
     user_prompt: str,
-    items: Sequence[Item],
+    items: Sequence[Item | Mapping[str, Any]],
     artist: str | None = None,
     album: str | None = None,
     va_likely: bool = False,
+    path_hints: PathHints | None = None,
 ) -> str:
     """
     Format the user prompt with the provided items and additional information.
+
+    With `path_hints`, the raw file paths are replaced by the file names and a
+    summary of the hints derived from the folder structure.
     """
     # Create user prompt with input file(s) metadata
     formatted_input = "\n\nINPUT FILES:\n["
-    for item in items:
+    for i, item in enumerate(items):
         formatted_input += "\n{"
+        if path_hints:
+            formatted_input += f'\n  "filename": "{path_hints["filenames"][i]}",'
         # TODO: Parsing
         for key, value in item.items():
+            if path_hints and key == "path":
+                continue
             if isinstance(value, str):
                 formatted_input += f'\n  "{key}": "{value}",'
             elif isinstance(value, list):
@@ -277,4 +687,33 @@ def _format_user_prompt(
         formatted_input += f"\n- ALBUMARTIST: {artist}"
     if va_likely:
         formatted_input += "\n- This is likely a compilation album (Various Artists)."
+
+    if path_hints:
+        formatted_input += _format_path_hints(path_hints)
     return user_prompt + formatted_input
+
+
+def _format_path_hints(path_hints: PathHints) -> str:
+    """Format the folder hints, see `PathIndex`."""
+    formatted = "\n\nFOLDER HINTS (derived from the folder structure of the import):"
+    formatted += f'\n- FOLDER: "{path_hints["folder"]}"'
+    if path_hints["prefix"]:
+        formatted += (
+            f'\n- All filenames start with "{path_hints["prefix"]}" (removed above)'
+        )
+    if path_hints["suffix"]:
+        formatted += (
+            f'\n- All filenames end with "{path_hints["suffix"]}" (removed above)'
+        )
+    if path_hints["artist"]:
+        formatted += f"\n- ARTIST (from folder): {path_hints['artist']}"
+    if path_hints["album"]:
+        formatted += f"\n- ALBUM (from folder): {path_hints['album']}"
+    if path_hints["label"]:
+        formatted += f"\n- LABEL (from folder): {path_hints['label']}"
+    if path_hints["year"]:
+        formatted += f"\n- YEAR (from folder): {path_hints['year']}"
+    if path_hints["promo"]:
+        promo = ", ".join(f'"{p}"' for p in path_hints["promo"])
+        formatted += f"\n- Promotional tags recurring across the import: {promo}"
+    return formatted
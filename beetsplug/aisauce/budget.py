@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import datetime
+import sqlite3
+import threading
+from collections import Counter
+from collections.abc import Iterator
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any
+
+from .types import Provider
+
+try:
+    import tiktoken
+except ImportError:  # optional, see the `budget` extra
+    tiktoken = None  # type: ignore[assignment]
+
+# Rough size of the JSON response per track, used for pre-flight estimates
+OUTPUT_TOKENS_PER_ITEM = 80
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimate the number of tokens of a prompt.
+
+    Uses tiktoken if installed, otherwise approximates with ~4 characters per
+    token, which is close enough for English and JSON-ish metadata.
+    """
+    if tiktoken is not None:
+        return len(_encoding().encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+@lru_cache
+def _encoding():
+    return tiktoken.get_encoding("cl100k_base")
+
+
+class BudgetGovernor:
+    """
+    Enforces the per-run and per-day token and cost ceilings of the providers.
+
+    Usage of the current run is kept in memory, the daily usage is persisted
+    in a SQLite database so it adds up across beets invocations. Requests in
+    flight count against the budget with their estimated size until their
+    actual usage is recorded.
+
+    The governor is created lazily on whichever thread first needs it, used
+    from the import threads and closed on `cli_exit`, so the connection and
+    the in-memory counters are shared between threads and guarded by a lock.
+    """
+
+    def __init__(self, providers: list[Provider], path: str):
+        self.providers = providers
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS usage (
+                    day TEXT NOT NULL,
+                    provider_id TEXT NOT NULL,
+                    tokens INTEGER NOT NULL,
+                    PRIMARY KEY (day, provider_id)
+                )
+                """
+            )
+        self._run_tokens: Counter[str] = Counter()
+        self._reserved_tokens: Counter[str] = Counter()
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    # ---------------------------------- Usage ----------------------------------- #
+
+    def day_tokens(self, provider: Provider) -> int:
+        """Return the tokens used today by the provider."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT tokens FROM usage WHERE day = ? AND provider_id = ?",
+                (_today(), provider["id"]),
+            ).fetchone()
+        return row[0] if row else 0
+
+    def run_tokens(self, provider: Provider) -> int:
+        """Return the tokens used in this run by the provider."""
+        with self._lock:
+            return self._run_tokens[provider["id"]]
+
+    def record(self, provider: Provider, tokens: int):
+        """Record the actual usage of a finished request."""
+        with self._lock, self.conn:
+            self._run_tokens[provider["id"]] += tokens
+            self.conn.execute(
+                """
+                INSERT INTO usage (day, provider_id, tokens) VALUES (?, ?, ?)
+                ON CONFLICT (day, provider_id) DO UPDATE SET tokens = tokens + ?
+                """,
+                (_today(), provider["id"], tokens, tokens),
+            )
+
+    def record_response(self, provider: Provider, response: Any):
+        """Record the usage reported in a chat completion response.
+
+        Meant as instructor `completion:response` hook, so retries count too.
+        """
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.record(provider, usage.total_tokens)
+
+    @contextmanager
+    def reserve(self, provider: Provider, tokens: int) -> Iterator[None]:
+        """Count an estimated request against the budget while it is in flight."""
+        with self._lock:
+            self._reserved_tokens[provider["id"]] += tokens
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._reserved_tokens[provider["id"]] -= tokens
+
+    # --------------------------------- Ceilings --------------------------------- #
+
+    def can_afford(self, provider: Provider, tokens: int) -> bool:
+        """Whether a request of the given size stays within all ceilings."""
+        budget = provider["budget"]
+        with self._lock:
+            reserved = self._reserved_tokens[provider["id"]] + tokens
+        run = self.run_tokens(provider) + reserved
+        day = self.day_tokens(provider) + reserved
+
+        for used, max_tokens, max_cost in (
+            (run, budget["max_tokens_per_run"], budget["max_cost_per_run"]),
+            (day, budget["max_tokens_per_day"], budget["max_cost_per_day"]),
+        ):
+            if max_tokens is not None and used > max_tokens:
+                return False
+            if max_cost is not None and cost(provider, used) > max_cost:
+                return False
+        return True
+
+    def select(self, provider: Provider, tokens: int) -> Provider | None:
+        """
+        Return the provider to send a request of the given size to.
+
+        That is the requested provider as long as its budget allows, otherwise
+        the next cheaper provider with enough budget left, or None if the
+        request should be skipped.
+        """
+        if self.can_afford(provider, tokens):
+            return provider
+
+        # Degrade step by step, from the most to the least expensive fallback
+        price = provider["budget"]["cost_per_1k_tokens"]
+        for fallback in sorted(
+            self.providers,
+            key=lambda p: p["budget"]["cost_per_1k_tokens"],
+            reverse=True,
+        ):
+            if fallback["budget"]["cost_per_1k_tokens"] >= price:
+                continue
+            if self.can_afford(fallback, tokens):
+                return fallback
+        return None
+
+
+def has_ceilings(provider: Provider) -> bool:
+    """Whether any token or cost ceiling is configured for the provider."""
+    return any(
+        value is not None
+        for key, value in provider["budget"].items()
+        if key.startswith("max_")
+    )
+
+
+def cost(provider: Provider, tokens: int) -> float:
+    """Return the cost of the given number of tokens with the provider."""
+    return tokens / 1000 * provider["budget"]["cost_per_1k_tokens"]
+
+
+def _today() -> str:
+    return datetime.date.today().isoformat()
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+from collections.abc import Sequence
+
+from .types import Job, JobState
+
+
+class JobQueue:
+    """
+    Durable queue of AI cleanup jobs backed by a SQLite database.
+
+    Every job is checkpointed as soon as its state changes, so an interrupted
+    run can be resumed without sending the finished requests again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    key TEXT NOT NULL UNIQUE,
+                    album_id INTEGER,
+                    item_ids TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    error TEXT
+                )
+                """
+            )
+
+    def close(self):
+        self.conn.close()
+
+    # --------------------------------- Enqueue ---------------------------------- #
+
+    def add_album(self, album_id: int) -> bool:
+        """Queue a cleanup job for an album. Returns False if already queued."""
+        return self._add(f"album:{album_id}", album_id, [])
+
+    def add_items(self, item_ids: Sequence[int]) -> bool:
+        """Queue a cleanup job for a set of items. Returns False if already queued."""
+        key = "items:" + ",".join(str(i) for i in sorted(item_ids))
+        return self._add(key, None, list(item_ids))
+
+    def _add(self, key: str, album_id: int | None, item_ids: list[int]) -> bool:
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO jobs (key, album_id, item_ids) VALUES (?, ?, ?)",
+                (key, album_id, json.dumps(item_ids)),
+            )
+        return cursor.rowcount > 0
+
+    # --------------------------------- Progress --------------------------------- #
+
+    def claim(self) -> Job | None:
+        """Mark the next pending job as in-flight and return it, or None if the
+        queue is drained."""
+        with self.conn:
+            row = self.conn.execute(
+                "SELECT * FROM jobs WHERE state = 'pending' ORDER BY id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE jobs SET state = 'in_flight' WHERE id = ?", (row["id"],)
+            )
+        return _job(row, state="in_flight")
+
+    def jobs(self, state: JobState) -> list[Job]:
+        """Return all jobs in the given state, without claiming them."""
+        return [
+            _job(row)
+            for row in self.conn.execute(
+                "SELECT * FROM jobs WHERE state = ? ORDER BY id", (state,)
+            )
+        ]
+
+    def mark_done(self, job_id: int):
+        self._set_state(job_id, "done")
+
+    def mark_failed(self, job_id: int, error: str):
+        self._set_state(job_id, "failed", error)
+
+    def _set_state(self, job_id: int, state: JobState, error: str | None = None):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET state = ?, error = ? WHERE id = ?",
+                (state, error, job_id),
+            )
+
+    # ---------------------------------- Resume ---------------------------------- #
+
+    def requeue(self, states: Sequence[JobState] = ("in_flight", "failed")) -> int:
+        """Put jobs in the given states back into the pending state.
+
+        Jobs left in-flight were interrupted before their result was applied,
+        so they have to be sent again when resuming a run.
+        """
+        placeholders = ", ".join("?" for _ in states)
+        with self.conn:
+            cursor = self.conn.execute(
+                f"UPDATE jobs SET state = 'pending', error = NULL WHERE state IN ({placeholders})",
+                tuple(states),
+            )
+        return cursor.rowcount
+
+    def clear(self):
+        """Remove all jobs from the queue."""
+        with self.conn:
+            self.conn.execute("DELETE FROM jobs")
+
+    def counts(self) -> dict[JobState, int]:
+        """Return the number of jobs per state."""
+        counts: dict[JobState, int] = {
+            "pending": 0,
+            "in_flight": 0,
+            "done": 0,
+            "failed": 0,
+        }
+        for row in self.conn.execute(
+            "SELECT state, COUNT(*) AS n FROM jobs GROUP BY state"
+        ):
+            counts[row["state"]] = row["n"]
+        return counts
+
+    @property
+    def unfinished(self) -> bool:
+        """Whether the queue still holds pending or in-flight jobs."""
+        counts = self.counts()
+        return counts["pending"] + counts["in_flight"] > 0
+
+
+def _job(row: sqlite3.Row, state: JobState | None = None) -> Job:
+    return Job(
+        id=row["id"],
+        album_id=row["album_id"],
+        item_ids=json.loads(row["item_ids"]),
+        state=state or row["state"],
+    )
@@ -0,0 +1,270 @@
+from __future__ import annotations
+
+import os
+import re
+from collections import Counter, defaultdict
+from collections.abc import Iterable, Sequence
+
+from beets.library import Item
+
+from .types import PathHints
+
+AUDIO_EXTENSIONS = frozenset(
+    (
+        ".aac",
+        ".aif",
+        ".aiff",
+        ".alac",
+        ".ape",
+        ".dsf",
+        ".flac",
+        ".m4a",
+        ".mp3",
+        ".mpc",
+        ".oga",
+        ".ogg",
+        ".opus",
+        ".wav",
+        ".wma",
+        ".wv",
+    )
+)
+
+# Bracketed segments like "[Free DL]" or "(www.example.com)"
+_SEGMENT_RE = re.compile(r"[\[({]([^\])}]+)[\])}]")
+# Segments that are promotional no matter how often they occur
+_PROMO_RE = re.compile(
+    r"free\s*(dl|download)|download|www\.|\.(com|net|org|ru)\b|soundcloud"
+    r"|bandcamp|youtube|promo|out now|buy\b",
+    re.IGNORECASE,
+)
+# Recurring segments which are part of the title and must not be stripped
+_VERSION_RE = re.compile(
+    r"mix|edit|version|remaster|live|feat|ft\.|vip|dub|bootleg|instrumental|acoustic",
+    re.IGNORECASE,
+)
+# Track markers which are part of the title too, however often they recur
+_TITLE_RE = re.compile(
+    _VERSION_RE.pattern
+    + r"|\b(bonus|explicit|clean|censored|demo|interlude|intro|outro|reprise"
+    r"|skit|hidden|extended|radio|part|pt)\b",
+    re.IGNORECASE,
+)
+# Edition markers in folder names, these stay part of the album title
+_EDITION_RE = re.compile(
+    _VERSION_RE.pattern
+    + r"|deluxe|expanded|anniversary|bonus|reissue|special|collector|limited",
+    re.IGNORECASE,
+)
+# Format and quality markers in folder names like "[FLAC 24-96]" or "(320)"
+_FORMAT_RE = re.compile(
+    r"(flac|alac|aac|mp3|ogg|opus|wav|aiff?|dsd|web|cd|vinyl|lp|lossless|hi-?res"
+    r"|v[02]|\d+\s*k(bps)?|\d{3}|(16|24)\s*-?\s*bit|(16|24)-\d{2,3}(\.\d)?)"
+    r"([\s,+/_]+|$)",
+    re.IGNORECASE,
+)
+# Release types and year ranges, which are never a label
+_RELEASE_TYPE_RE = re.compile(
+    r"^(ep|single|album|lp|mini-?album|compilation|mixtape|soundtrack|ost|bootleg)$",
+    re.IGNORECASE,
+)
+# Catalog numbers are upper case, e.g. "WARP123" or "CAT-001"
+_CATALOG_RE = re.compile(r"^[A-Z]{2,}[\s-]?\d+[A-Z]?$")
+_YEAR_RANGE_RE = re.compile(r"^(19|20)\d{2}\s*[-/]\s*((19|20)?\d{2})$")
+_YEAR_RE = re.compile(r"^(19|20)\d{2}$")
+_DISC_RE = re.compile(r"^(cd|dis[ck])\s*\d+$", re.IGNORECASE)
+# Segments found in this many album folders are considered recurring
+_RECURRING_DIRS = 3
+# Tag fields scanned for recurring segments
+_TAG_FIELDS = ("title", "artist", "album", "comments")
+
+
+class PathIndex:
+    """
+    In-memory index over the files of an import, built once per session.
+
+    Tokenizes folder names, file names and tag values to find hints shared by
+    whole folders (artist, album, label and year in the folder name, filename
+    prefixes and suffixes) and promotional segments recurring across albums.
+    These are sent to the AI as compact `PathHints` instead of the raw paths,
+    so the model does not have to re-derive them for every album.
+    """
+
+    def __init__(self):
+        # Directory -> file names of the audio files in it
+        self._files: dict[str, set[str]] = defaultdict(set)
+        # Directory -> number of album directories directly below it
+        self._album_dirs: Counter[str] = Counter()
+        # Normalized segment -> directories it was found in
+        self._segment_dirs: dict[str, set[str]] = defaultdict(set)
+        self._seen_items: set[bytes] = set()
+        # Import roots (or the library directory), never an artist folder
+        self.roots: set[str] = set()
+
+    # ---------------------------------- Build ----------------------------------- #
+
+    def add_tree(self, root: bytes | str):
+        """Index all audio files below the given directory (or a single file)."""
+        root = os.fsdecode(root)
+        if os.path.isfile(root):
+            self.add_file(root)
+            return
+        self.roots.add(os.path.normpath(root))
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                if os.path.splitext(filename)[1].lower() in AUDIO_EXTENSIONS:
+                    self.add_file(os.path.join(dirpath, filename))
+
+    def add_file(self, path: bytes | str):
+        directory, filename = os.path.split(os.fsdecode(path))
+        files = self._files[directory]
+        if filename in files:
+            return
+        if not files:
+            self._album_dirs[os.path.dirname(directory)] += 1
+        files.add(filename)
+        self._add_segments(os.path.splitext(filename)[0], directory)
+
+    def add_items(self, items: Iterable[Item]):
+        """Index the paths and tag values of the items, each item only once."""
+        for item in items:
+            if item.path in self._seen_items:
+                continue
+            self._seen_items.add(item.path)
+            self.add_file(item.path)
+            directory = os.path.dirname(os.fsdecode(item.path))
+            for field in _TAG_FIELDS:
+                value = item.get(field)
+                if isinstance(value, str):
+                    self._add_segments(value, directory)
+
+    def _add_segments(self, text: str, directory: str):
+        for segment in _SEGMENT_RE.findall(text):
+            self._segment_dirs[_normalize(segment)].add(directory)
+
+    # ---------------------------------- Query ----------------------------------- #
+
+    def is_promo(self, segment: str) -> bool:
+        """Whether a bracketed segment looks promotional."""
+        if _PROMO_RE.search(segment):
+            return True
+        if _TITLE_RE.search(segment):
+            return False
+        return len(self._segment_dirs.get(_normalize(segment), ())) >= _RECURRING_DIRS
+
+    def hints(self, items: Sequence[Item]) -> PathHints:
+        """Return the hints for the items of one album (or a single track)."""
+        paths = [os.fsdecode(item.path) for item in items]
+        directory = os.path.commonpath([os.path.dirname(p) for p in paths])
+        # Multi-disc releases: the album folder is the parent of "CD1", "CD2"
+        if _DISC_RE.match(os.path.basename(directory)):
+            directory = os.path.dirname(directory)
+        folder = os.path.basename(directory)
+
+        stems = [os.path.splitext(os.path.basename(p))[0] for p in paths]
+        # All files of the folder give a more reliable prefix than the items alone
+        siblings = [
+            os.path.splitext(f)[0] for f in self._files.get(directory, ())
+        ] or stems
+        prefix, suffix = _common_affixes(siblings) if len(siblings) > 1 else ("", "")
+
+        hints = PathHints(
+            folder=folder,
+            filenames=[
+                _strip_affixes(os.path.basename(p), stem, prefix, suffix)
+                for p, stem in zip(paths, stems)
+            ],
+            prefix=prefix,
+            suffix=suffix,
+            artist=None,
+            album=None,
+            label=None,
+            year=None,
+            promo=[],
+        )
+
+        # Folder names like "Artist - Album (Deluxe Edition) (2020) [Label] [FLAC]"
+        # Takes the hints from a segment, returns what remains in the album title
+        def _folder_segment(match: re.Match[str]) -> str:
+            segment = match.group(1).strip()
+            if _EDITION_RE.search(segment):
+                return match.group(0)
+            if _YEAR_RE.match(segment):
+                hints["year"] = int(segment)
+            elif (
+                _is_format(segment)
+                or _RELEASE_TYPE_RE.match(segment)
+                or _CATALOG_RE.match(segment)
+                or _YEAR_RANGE_RE.match(segment)
+                or self.is_promo(segment)
+            ):
+                pass
+            elif not match.group(0).startswith("["):
+                # Unknown parenthesized segments are rather part of the title
+                return match.group(0)
+            elif hints["label"] is None:
+                hints["label"] = segment
+            return ""
+
+        remainder = _SEGMENT_RE.sub(_folder_segment, folder)
+        remainder = " ".join(remainder.split()).strip(" -_")
+        if " - " in remainder:
+            artist, album = remainder.split(" - ", 1)
+            hints["artist"], hints["album"] = artist.strip(), album.strip()
+        elif remainder:
+            hints["album"] = remainder
+            # "Artist/Album" layout: the parent holds several album folders
+            parent = os.path.dirname(directory)
+            if parent not in self.roots and self._album_dirs[parent] > 1:
+                hints["artist"] = os.path.basename(parent)
+
+        texts = stems + [
+            value
+            for item in items
+            for field in _TAG_FIELDS
+            if isinstance(value := item.get(field), str)
+        ]
+        promo: dict[str, None] = {}
+        for text in texts:
+            for segment in _SEGMENT_RE.findall(text):
+                if self.is_promo(segment):
+                    promo.setdefault(segment.strip(), None)
+        hints["promo"] = list(promo)
+
+        return hints
+
+
+def _is_format(segment: str) -> bool:
+    """Whether a segment only consists of format and quality markers."""
+    return _FORMAT_RE.sub("", segment) == ""
+
+
+def _normalize(segment: str) -> str:
+    return " ".join(segment.lower().split())
+
+
+def _common_affixes(names: Sequence[str]) -> tuple[str, str]:
+    """Return the prefix and suffix shared by all names, cut at a separator."""
+    prefix = os.path.commonprefix(list(names))
+    suffix = os.path.commonprefix([n[::-1] for n in names])[::-1]
+    # Do not cut into words, e.g. "Track 10" and "Track 11" share "Track 1"
+    prefix = prefix[: _last_separator(prefix) + 1]
+    suffix = suffix[len(suffix) - _last_separator(suffix[::-1]) - 1 :]
+    if len(prefix.strip(" -_")) < 3:
+        prefix = ""
+    if len(suffix.strip(" -_")) < 3:
+        suffix = ""
+    return prefix, suffix
+
+
+def _last_separator(text: str) -> int:
+    return max(text.rfind(" "), text.rfind("_"))
+
+
+def _strip_affixes(filename: str, stem: str, prefix: str, suffix: str) -> str:
+    stripped = stem
+    if prefix and stripped.startswith(prefix):
+        stripped = stripped[len(prefix) :]
+    if suffix and stripped.endswith(suffix):
+        stripped = stripped[: -len(suffix)]
+    return (stripped.strip() or stem) + filename[len(stem) :]
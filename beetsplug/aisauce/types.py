@@ -1,13 +1,24 @@
 from __future__ import annotations
 
 
-from typing import TypedDict
+from collections.abc import Mapping, Sequence
+from typing import Any, Literal, TypedDict
 from beets.library import Item
 from pydantic import BaseModel
 
 from beets.autotag import TrackInfo, AlbumInfo
 
 
+class Budget(TypedDict):
+    """Token and cost ceilings of a provider, None means unlimited."""
+
+    cost_per_1k_tokens: float
+    max_tokens_per_run: int | None
+    max_tokens_per_day: int | None
+    max_cost_per_run: float | None
+    max_cost_per_day: float | None
+
+
 class Provider(TypedDict):
     """A provider for open ai api."""
 
@@ -15,6 +26,7 @@ class Provider(TypedDict):
     api_key: str
     api_base_url: str
     model: str
+    budget: Budget
 
 
 class AISauceSource(TypedDict):
@@ -25,6 +37,32 @@ class AISauceSource(TypedDict):
     system_prompt: str
 
 
+class PathHints(TypedDict):
+    """Compact hints derived from the folder structure, see `PathIndex`."""
+
+    folder: str
+    filenames: list[str]  # without the shared prefix and suffix
+    prefix: str
+    suffix: str
+    artist: str | None
+    album: str | None
+    label: str | None
+    year: int | None
+    promo: list[str]
+
+
+JobState = Literal["pending", "in_flight", "done", "failed"]
+
+
+class Job(TypedDict):
+    """A queued AI cleanup job, either for an album or a set of items."""
+
+    id: int
+    album_id: int | None
+    item_ids: list[int]
+    state: JobState
+
+
 class TrackInfoAIResponse(BaseModel):
     filename: str | None
     title: str
@@ -83,64 +121,90 @@ class AlbumInfoAIResponse(BaseModel):
             **kwargs,
         )
 
-    def apply_to_items(self, items: list[Item]) -> list[dict[str, dict[str, str]]]:
+    def apply_to_items(self, items: list[Item]) -> list[ItemChanges]:
         """
         Apply the AI response data to a list of Beets Item objects
         and return a diff of changes made.
 
         Returns:
-            dict: A dictionary containing:
-                - 'applied_changes': list of dicts showing changes per item
-                - 'summary': dict with counts of total changes by field
+            list: One dict per item mapping the changed fields to
+                their 'old' and 'new' values.
         """
-        applied_changes = []
+        applied_changes = self.diff([item_snapshot(item) for item in items])
+        apply_changes(items, applied_changes)
+        return applied_changes
 
-        for i, (ai_track, item) in enumerate(zip(self.tracks, items)):
-            # Track changes for each field
-            changes = {}
+    def diff(self, snapshots: Sequence[Mapping[str, Any]]) -> list[ItemChanges]:
+        """
+        Compute the changes this response would make to the given item
+        snapshots (see `item_snapshot`), without touching any Item.
 
-            if item.title != ai_track.title:
-                changes["title"] = {"old": item.title, "new": ai_track.title}
-                item.title = ai_track.title
+        Only works on plain values, so it can also run in a worker process.
+        """
+        applied_changes = []
 
-            if item.artist != ai_track.artist:
-                changes["artist"] = {"old": item.artist, "new": ai_track.artist}
-                item.artist = ai_track.artist
+        # Album-level values win over the per-track ones, so that an album and
+        # all of its items end up agreeing
+        album_values = {
+            "album": self.album_title,
+            "albumartist": self.album_artist,
+            "genre": self.genre,
+            "year": self.year,
+            "label": self.label,
+            "comp": self.is_compilation,
+        }
+        album_values = {k: v for k, v in album_values.items() if v is not None}
+
+        for ai_track, old in zip(self.tracks, snapshots):
+            new = {
+                "title": ai_track.title,
+                "artist": ai_track.artist,
+                "album": ai_track.album,
+                "albumartist": ai_track.album_artist,
+                "genre": ai_track.genres,
+                "year": ai_track.year,
+                "comment": ai_track.comment,
+                "length": ai_track.length,
+                "track": ai_track.index,
+            }
+            new.update(album_values)
+
+            # Track changes for each field, missing AI values are never applied
+            changes: ItemChanges = {}
+            for field, value in new.items():
+                if value is not None and old[field] != value:
+                    changes[field] = {"old": old[field], "new": value}
 
-            if item.album != ai_track.album:
-                changes["album"] = {"old": item.album, "new": ai_track.album}
-                item.album = ai_track.album
+            applied_changes.append(changes)
 
-            if (
-                ai_track.album_artist is not None
-                and item.albumartist != ai_track.album_artist
-            ):
-                changes["albumartist"] = {
-                    "old": item.albumartist,
-                    "new": ai_track.album_artist,
-                }
-                item.albumartist = ai_track.album_artist
+        return applied_changes
 
-            if ai_track.genres is not None and item.genre != ai_track.genres:
-                changes["genre"] = {"old": item.genre, "new": ai_track.genres}
-                item.genre = ai_track.genres
 
-            if ai_track.year is not None and item.year != ai_track.year:
-                changes["year"] = {"old": item.year, "new": ai_track.year}
-                item.year = ai_track.year
+# Item fields compared by `AlbumInfoAIResponse.diff`
+DIFF_FIELDS = (
+    "title",
+    "artist",
+    "album",
+    "albumartist",
+    "genre",
+    "year",
+    "comment",
+    "length",
+    "track",
+    "label",
+    "comp",
+)
 
-            if ai_track.comment is not None and item.comment != ai_track.comment:
-                changes["comment"] = {"old": item.comment, "new": ai_track.comment}
-                item.comment = ai_track.comment
+ItemChanges = dict[str, dict[str, Any]]
 
-            if ai_track.length is not None and item.length != ai_track.length:
-                changes["length"] = {"old": item.length, "new": ai_track.length}
-                item.length = ai_track.length
 
-            if ai_track.index is not None and item.track != ai_track.index:
-                changes["track"] = {"old": item.track, "new": ai_track.index}
-                item.track = ai_track.index
+def item_snapshot(item: Item) -> dict[str, Any]:
+    """Return the current values of the diffed fields of an item."""
+    return {field: item.get(field) for field in DIFF_FIELDS}
 
-            applied_changes.append(changes)
 
-        return applied_changes
+def apply_changes(items: Sequence[Item], changes: Sequence[ItemChanges]):
+    """Set the new values of a diff on the items."""
+    for item, item_changes in zip(items, changes):
+        for field, change in item_changes.items():
+            setattr(item, field, change["new"])
@@ -0,0 +1,37 @@
+from __future__ import annotations
+
+from collections.abc import Callable, Mapping, Sequence
+from typing import Any, TypeVar
+
+from beets.library import Item
+from pydantic import BaseModel
+
+from .types import AlbumInfoAIResponse, ItemChanges
+
+# Helpers for the optional process pool. Only plain data crosses the process
+# boundary: field dicts of items and raw JSON bytes go in, never `Item` objects.
+
+R = TypeVar("R", bound=BaseModel)
+
+
+def item_rows(items: Sequence[Item]) -> list[dict[str, Any]]:
+    """Return all fields of the items as plain dicts, e.g. for prompt rendering."""
+    return [dict(item.items()) for item in items]
+
+
+def validate_response(
+    type: type[R],
+    raw: bytes,
+    process: Callable[[R], Any] | None = None,
+) -> Any:
+    """Parse and validate a raw JSON response, optionally processing it further."""
+    response = type.model_validate_json(raw)
+    return response if process is None else process(response)
+
+
+def diff_response(
+    response: AlbumInfoAIResponse,
+    snapshots: Sequence[Mapping[str, Any]],
+) -> tuple[AlbumInfoAIResponse, list[ItemChanges]]:
+    """Compute the changes of a cleanup response to the items."""
+    return response, response.diff(snapshots)
@@ -1,14 +1,24 @@
 import asyncio
 import os
+import shutil
+import tempfile
+import threading
+from types import SimpleNamespace
+from unittest.mock import patch
 from beets.test.helper import PluginTestCase
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 import pytest
 from beets.library import Item
 from beetsplug import aisauce
 from beetsplug.aisauce.ai import (
     get_ai_client,
     get_structured_output,
+    json_schema,
 )
+from beetsplug.aisauce.budget import BudgetGovernor, estimate_tokens
+from beetsplug.aisauce.jobs import JobQueue
+from beetsplug.aisauce.paths import PathIndex
+from beetsplug.aisauce.types import AlbumInfoAIResponse, TrackInfoAIResponse
 
 
 class AISauceConfigTestCase(PluginTestCase):
@@ -191,6 +201,518 @@ class AISauceTestCase(PluginTestCase):
         assert result is None
 
 
+class AlbumInfoTestCase(PluginTestCase):
+    plugin = "aisauce"
+
+    def test_shared_strings(self):
+        raw = _dummy_response.model_copy(
+            update={"tracks": _dummy_response.tracks * 3}
+        ).model_dump_json()
+        info = AlbumInfoAIResponse.model_validate_json(raw).to_album_info(
+            data_source="AISauce"
+        )
+
+        assert len(info.tracks) == 3
+        # pydantic caches repeated strings while parsing the JSON response
+        assert info.tracks[0].album is info.tracks[2].album is info.album
+
+
+class PathIndexTestCase(PluginTestCase):
+    plugin = "aisauce"
+
+    def setUp(self):
+        super().setUp()
+        self.root = os.fsencode(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root)
+        for folder, names in {
+            b"Artist - Album (2020) [Some Label]": [
+                b"Artist - Album - 01 Intro [free dl].mp3",
+                b"Artist - Album - 02 Outro [free dl].mp3",
+                b"cover.jpg",
+            ],
+            b"Other Artist/First Album": [b"01 Song (Ripped).mp3"],
+            b"Other Artist/Second Album": [b"01 Other (Ripped).mp3"],
+            b"Third Artist/Album": [b"01 Third (Ripped).mp3"],
+        }.items():
+            os.makedirs(os.path.join(self.root, folder))
+            for name in names:
+                open(os.path.join(self.root, folder, name), "wb").close()
+
+        self.index = PathIndex()
+        self.index.add_tree(self.root)
+
+    def _item(self, *parts: bytes, **values) -> Item:
+        return Item(path=os.path.join(self.root, *parts), **values)
+
+    def test_folder_name(self):
+        folder = b"Artist - Album (2020) [Some Label]"
+        items = [
+            self._item(folder, b"Artist - Album - 01 Intro [free dl].mp3"),
+            self._item(folder, b"Artist - Album - 02 Outro [free dl].mp3"),
+        ]
+        hints = self.index.hints(items)
+
+        assert hints["folder"] == folder.decode()
+        assert hints["artist"] == "Artist"
+        assert hints["album"] == "Album"
+        assert hints["year"] == 2020
+        assert hints["label"] == "Some Label"
+        assert hints["prefix"] == "Artist - Album - "
+        assert hints["suffix"] == " [free dl]"
+        assert hints["filenames"] == ["01 Intro.mp3", "02 Outro.mp3"]
+        assert hints["promo"] == ["free dl"]
+
+    def test_artist_folder(self):
+        hints = self.index.hints(
+            [self._item(b"Other Artist/First Album", b"01 Song (Ripped).mp3")]
+        )
+        assert hints["artist"] == "Other Artist"
+        assert hints["album"] == "First Album"
+        # Recurs in 3 folders
+        assert hints["promo"] == ["Ripped"]
+
+        # Only one album below the parent folder, so no artist hint
+        hints = self.index.hints(
+            [self._item(b"Third Artist/Album", b"01 Third (Ripped).mp3")]
+        )
+        assert hints["artist"] is None
+
+    def test_edition_and_format(self):
+        for folder, album, label in (
+            (b"Artist - Album (Deluxe Edition)", "Album (Deluxe Edition)", None),
+            (b"Artist - Album [FLAC]", "Album", None),
+            (b"Artist - Album (Remastered)", "Album (Remastered)", None),
+            (b"Artist - Album (2020) [Warp] [WEB FLAC 24-96]", "Album", "Warp"),
+            (b"Artist - Album (MP3 320) [Planet Mu]", "Album", "Planet Mu"),
+            (b"Artist - Album [EP]", "Album", None),
+            (b"Artist - Album (Single)", "Album", None),
+            (b"Artist - Album [CAT001]", "Album", None),
+            (b"Artist - Album (2019-2021)", "Album", None),
+            (b"Artist - Album (Part 2) [Warp]", "Album (Part 2)", "Warp"),
+        ):
+            hints = self.index.hints([self._item(folder, b"01 Track.flac")])
+            assert hints["album"] == album, folder
+            assert hints["label"] == label, folder
+
+        # Only the bracketed segment is removed, not every copy of its text
+        for folder, artist, album, label in (
+            (b"Van Halen - 1984 (1984)", "Van Halen", "1984", None),
+            (
+                b"Ninja Tune - Ninja Tune XX [Ninja Tune]",
+                "Ninja Tune",
+                "Ninja Tune XX",
+                "Ninja Tune",
+            ),
+        ):
+            hints = self.index.hints([self._item(folder, b"01 Track.flac")])
+            assert (hints["artist"], hints["album"]) == (artist, album), folder
+            assert hints["label"] == label, folder
+
+    def test_recurring_title_markers(self):
+        index = PathIndex()
+        for album in ("A", "B", "C"):
+            index.add_file(f"/music/{album}/01 Song (Bonus Track) [Explicit].mp3")
+            index.add_file(f"/music/{album}/02 Song (Ripped).mp3")
+
+        assert not index.is_promo("Bonus Track")
+        assert not index.is_promo("Explicit")
+        assert index.is_promo("Ripped")
+
+    def test_prompt(self):
+        folder = b"Artist - Album (2020) [Some Label]"
+        items = [
+            self._item(folder, b"Artist - Album - 01 Intro [free dl].mp3", title="x"),
+            self._item(folder, b"Artist - Album - 02 Outro [free dl].mp3", title="y"),
+        ]
+        prompt = aisauce.aisauce._format_user_prompt(
+            "", items, path_hints=self.index.hints(items)
+        )
+        assert '"filename": "01 Intro.mp3"' in prompt
+        assert self.root.decode() not in prompt
+        assert "LABEL (from folder): Some Label" in prompt
+
+
+class BudgetTestCase(PluginTestCase):
+    plugin = "aisauce"
+
+    def setUp(self):
+        super().setUp()
+        self.ai = aisauce.AISauce()
+        self.ai.config.set(
+            {
+                "providers": [
+                    {
+                        **_dummy_provider,
+                        "budget": {
+                            "cost_per_1k_tokens": 1.0,
+                            "max_cost_per_run": 1.0,
+                        },
+                    },
+                    {
+                        **_dummy_provider,
+                        "id": "Cheap",
+                        "budget": {
+                            "cost_per_1k_tokens": 0.1,
+                            "max_tokens_per_day": 1500,
+                        },
+                    },
+                ],
+                "sources": [],
+            }
+        )
+        self.expensive, self.cheap = self.ai.providers
+        self.path = os.path.join(os.path.dirname(self.ai.queue_path), "usage.db")
+        self.budget = BudgetGovernor(self.ai.providers, self.path)
+
+    def tearDown(self):
+        self.budget.close()
+        super().tearDown()
+
+    def test_other_thread(self):
+        # Created lazily in an import thread, closed on the main thread
+        budgets = []
+        thread = threading.Thread(
+            target=lambda: budgets.append(BudgetGovernor(self.ai.providers, self.path))
+        )
+        thread.start()
+        thread.join()
+
+        budget = budgets[0]
+        budget.record(self.cheap, 100)
+        assert budget.day_tokens(self.cheap) == 100
+        budget.close()
+
+    def test_concurrent_reserve(self):
+        def reserve():
+            for _ in range(1000):
+                with self.budget.reserve(self.cheap, 10):
+                    pass
+
+        threads = [threading.Thread(target=reserve) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert self.budget.can_afford(self.cheap, 1500)
+
+    def test_no_ceilings(self):
+        # Explicitly unset, as confuse falls back to the providers of setUp
+        ceilings = dict.fromkeys(self.cheap["budget"].keys() - {"cost_per_1k_tokens"})
+        self.ai.config["providers"].set([{**_dummy_provider, "budget": ceilings}])
+
+        async def fake_output(**kwargs):
+            return _dummy_response
+
+        with patch.object(aisauce.aisauce, "get_structured_output", fake_output):
+            out = self.ai.candidates(
+                items=[Item(title="x")], artist="", album="", va_likely=False
+            )
+
+        # Usage is neither estimated nor tracked without any budget
+        assert len(out) == 1
+        assert self.ai.budget is None
+        usage_path = os.path.join(os.path.dirname(self.path), "aisauce_usage.db")
+        assert not os.path.exists(usage_path)
+
+    def test_estimate_tokens(self):
+        assert estimate_tokens("") >= 0
+        assert estimate_tokens("some text " * 100) > estimate_tokens("some text")
+
+    def test_degrade(self):
+        assert self.budget.select(self.expensive, 500)["id"] == "Dummy"  # type: ignore[index]
+
+        # Used up by requests in flight and recorded usage
+        with self.budget.reserve(self.expensive, 600):
+            assert self.budget.select(self.expensive, 500)["id"] == "Cheap"  # type: ignore[index]
+        self.budget.record(self.expensive, 900)
+        assert self.budget.select(self.expensive, 500)["id"] == "Cheap"  # type: ignore[index]
+
+        # Nothing cheaper than the cheapest provider, skip
+        self.budget.record(self.cheap, 1200)
+        assert self.budget.select(self.expensive, 500) is None
+        assert self.budget.select(self.cheap, 500) is None
+
+    def test_degrade_step_by_step(self):
+        middle = {
+            **self.cheap,
+            "id": "Middle",
+            "budget": {**self.cheap["budget"], "cost_per_1k_tokens": 0.5},
+        }
+        self.budget.providers = [self.expensive, middle, self.cheap]  # type: ignore[list-item]
+
+        self.budget.record(self.expensive, 900)
+        assert self.budget.select(self.expensive, 500)["id"] == "Middle"  # type: ignore[index]
+
+    def test_day_persisted(self):
+        self.budget.record(self.cheap, 1000)
+        self.budget.record(self.cheap, 200)
+        self.budget.close()
+
+        # New run, same day
+        self.budget = BudgetGovernor(self.ai.providers, self.path)
+        assert self.budget.run_tokens(self.cheap) == 0
+        assert self.budget.day_tokens(self.cheap) == 1200
+        assert not self.budget.can_afford(self.cheap, 500)
+
+    def test_estimate_schema(self):
+        with patch.object(BudgetGovernor, "select", return_value=None) as select:
+            self.ai.candidates(
+                items=[Item(title="x")], artist="", album="", va_likely=False
+            )
+
+        # The response schema is sent with every request, so it counts too
+        schema = estimate_tokens(json_schema(AlbumInfoAIResponse))
+        assert select.call_args.args[1] > schema
+
+    def test_skip_candidates(self):
+        self.ai.config["providers"].set(
+            [{**_dummy_provider, "budget": {"max_tokens_per_run": 1}}]
+        )
+
+        async def fake_output(**kwargs):
+            raise AssertionError("No request expected")
+
+        with patch.object(aisauce.aisauce, "get_structured_output", fake_output):
+            out = self.ai.candidates(
+                items=[Item(title="x")], artist="", album="", va_likely=False
+            )
+        assert out == []
+
+
+class JobQueueTestCase(PluginTestCase):
+    plugin = "aisauce"
+
+    def setUp(self):
+        super().setUp()
+        # Defaults to the beets directory, which is temporary in tests
+        self.path = aisauce.AISauce().queue_path
+        self.queue = JobQueue(self.path)
+
+    def tearDown(self):
+        self.queue.close()
+        super().tearDown()
+
+    def test_add_and_claim(self):
+        assert self.queue.add_album(1)
+        assert self.queue.add_items([3, 2])
+        # Same jobs are only queued once
+        assert not self.queue.add_album(1)
+        assert not self.queue.add_items([2, 3])
+
+        job = self.queue.claim()
+        assert job is not None
+        assert job["album_id"] == 1
+        assert job["state"] == "in_flight"
+
+        job = self.queue.claim()
+        assert job is not None
+        assert job["album_id"] is None
+        assert job["item_ids"] == [3, 2]
+
+        assert self.queue.claim() is None
+
+    def test_jobs(self):
+        self.queue.add_album(1)
+        self.queue.add_album(2)
+        self.queue.claim()
+
+        assert [j["album_id"] for j in self.queue.jobs("pending")] == [2]
+        assert [j["album_id"] for j in self.queue.jobs("in_flight")] == [1]
+
+    def test_resume(self):
+        self.queue.add_album(1)
+        self.queue.add_album(2)
+        self.queue.add_album(3)
+
+        done, failed, _ = (self.queue.claim() for _ in range(3))
+        self.queue.mark_done(done["id"])  # type: ignore[index]
+        self.queue.mark_failed(failed["id"], "boom")  # type: ignore[index]
+        assert self.queue.unfinished
+
+        # Persisted across connections
+        self.queue.close()
+        self.queue = JobQueue(self.path)
+        assert self.queue.counts() == {
+            "pending": 0,
+            "in_flight": 1,
+            "done": 1,
+            "failed": 1,
+        }
+
+        # Only interrupted and failed jobs are sent again
+        assert self.queue.requeue() == 2
+        claimed = [self.queue.claim(), self.queue.claim()]
+        assert {j["album_id"] for j in claimed} == {2, 3}  # type: ignore[index]
+        assert self.queue.claim() is None
+
+
+class CleanupCommandTestCase(PluginTestCase):
+    plugin = "aisauce"
+
+    def setUp(self):
+        super().setUp()
+        self.ai = aisauce.AISauce()
+        self.ai.config.set(
+            {
+                "providers": [_dummy_provider],
+                "sources": [],
+            }
+        )
+
+    def _cleanup(
+        self,
+        *args: str,
+        response=None,
+        **opts: bool,
+    ) -> list[dict]:
+        """Run the cleanup command against a fake AI, returning the requests sent.
+
+        The fake answers with `response` (`_dummy_response` by default) or
+        raises it, with and without the process pool.
+        """
+        response = response or _dummy_response
+        calls: list[dict] = []
+
+        async def fake_output(**kwargs):
+            calls.append(kwargs)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        async def fake_json_output(**kwargs):
+            return (await fake_output(**kwargs)).model_dump_json().encode()
+
+        options = {"singletons": False, "resume": False, "restart": False, **opts}
+        with (
+            patch.object(aisauce.aisauce, "get_structured_output", fake_output),
+            patch.object(aisauce.aisauce, "get_json_output", fake_json_output),
+        ):
+            self.ai.cleanup_command(self.lib, SimpleNamespace(**options), list(args))
+        return calls
+
+    def test_cleanup_albums(self):
+        album = self.add_album(title="track 1 [free dl]", album="ALBUM")
+
+        calls = self._cleanup()
+        # Finished albums are not sent again on resume
+        calls += self._cleanup(resume=True)
+
+        assert len(calls) == 1
+        item = album.items()[0]
+        assert item.title == "Track 1"
+        assert item.album == "Album"
+        album.load()
+        assert album.album == "Album"
+
+    def test_album_fields(self):
+        album = self.add_album(title="track 1", album="ALBUM", year=1999)
+        self._cleanup(
+            response=_dummy_response.model_copy(update={"year": 2020, "label": "Warp"})
+        )
+
+        # The album values of the response reach the items and the album alike
+        item = album.items()[0]
+        album.load()
+        assert (item.year, item.label, item.albumartist) == (2020, "Warp", "Artist")
+        assert (album.year, album.label, album.albumartist) == (2020, "Warp", "Artist")
+
+    def test_unchanged_items(self):
+        self.add_album(
+            title="Track 1", artist="Artist", album="Album", albumartist="Artist"
+        )
+        with patch.object(Item, "try_sync") as try_sync:
+            self._cleanup()
+
+        try_sync.assert_not_called()
+
+    def test_cleanup_without_path_hints(self):
+        album = self.add_album(title="track 1 [free dl]", album="ALBUM")
+        self.ai.config["path_hints"].set(False)
+
+        calls = self._cleanup()
+
+        assert len(calls) == 1
+        assert "FOLDER HINTS" not in calls[0]["user_prompt"]
+        assert album.items()[0].title == "Track 1"
+
+    def test_resume_query(self):
+        rock = self.add_album(title="rock track", album="ROCK")
+        jazz = self.add_album(title="jazz track", album="JAZZ")
+
+        # Interrupted run: the job is sent but never checkpointed as done
+        with patch.object(JobQueue, "mark_done"):
+            self._cleanup("album:ROCK")
+
+        # Resuming without a query only sends the album of the interrupted run
+        calls = self._cleanup(resume=True)
+
+        assert len(calls) == 1
+        assert jazz.items()[0].title == "jazz track"
+        # Only the queued album is indexed for the folder hints
+        assert self.ai.path_index._seen_items == {i.path for i in rock.items()}
+
+    def test_cleanup_process_pool(self):
+        album = self.add_album(title="track 1 [free dl]", album="ALBUM")
+        self.ai.config["processes"].set(1)
+
+        try:
+            calls = self._cleanup()
+        finally:
+            self.ai.shutdown_pool()
+
+        assert "track 1 [free dl]" in calls[0]["user_prompt"]
+        item = album.items()[0]
+        assert item.title == "Track 1"
+        assert item.album == "Album"
+
+    def test_unfinished_run(self):
+        queue = JobQueue(self.ai.queue_path)
+        queue.add_album(1)
+        queue.close()
+
+        with pytest.raises(aisauce.aisauce.UserError):
+            self._cleanup()
+
+    def test_resume_and_restart(self):
+        with pytest.raises(aisauce.aisauce.UserError):
+            self._cleanup(resume=True, restart=True)
+
+    def test_failed_request(self):
+        self.add_album(title="track 1", album="ALBUM")
+        self._cleanup(
+            response=ValidationError.from_exception_data("AlbumInfoAIResponse", [])
+        )
+
+        queue = JobQueue(self.ai.queue_path)
+        assert queue.counts()["failed"] == 1
+        queue.close()
+
+
+_dummy_response = AlbumInfoAIResponse(
+    tracks=[
+        TrackInfoAIResponse(
+            filename=None,
+            title="Track 1",
+            artist="Artist",
+            album="Album",
+            album_artist="Artist",
+            genres=None,
+            year=None,
+            comment=None,
+            length=None,
+            index=None,
+        )
+    ],
+    album_title="Album",
+    album_artist="Artist",
+    genre=None,
+    year=None,
+    label=None,
+    is_compilation=False,
+)
+
+
 _dummy_provider = {
     "id": "Dummy",
     "api_key": "your_api_key_here",